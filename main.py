@@ -5,7 +5,7 @@ import logging
 import math
 import sys
 from fractions import Fraction
-from typing import List
+from typing import List, Union
 
 from solver import solve, knapsack
 from solver.util import lcm, gcd
@@ -15,8 +15,16 @@ from solver.wq import WeightQualification
 logger = logging.getLogger(__name__)
 
 
-def parse_input(inp: str) -> List[Fraction]:
-    return [Fraction(s) for s in inp.split()]
+def parse_input(inp: str) -> List[Union[int, Fraction]]:
+    return [parse_number(s) for s in inp.split()]
+
+
+def parse_number(s: str) -> Union[int, Fraction]:
+    # Weights are usually integers, which are much cheaper to parse and to process than fractions
+    try:
+        return int(s)
+    except ValueError:
+        return Fraction(s)
 
 
 def main(argv: List[str]) -> None:
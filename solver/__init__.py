@@ -1,9 +1,11 @@
 import logging
 from fractions import Fraction
-from math import floor, ceil
-from typing import List, Union
+from math import ceil
+from typing import Dict, List, Optional, Tuple, Union
 
-from solver.knapsack import knapsack, knapsack_upper_bound
+import numpy as np
+
+from solver.knapsack import knapsack, knapsack_table, knapsack_upper_bound, MAX_INT_64
 from solver.wq import WeightQualification
 from solver.wr import WeightRestriction
 
@@ -35,25 +37,57 @@ def wr_upper_bound_s(inst: WeightRestriction) -> Fraction:
     # s := \frac{\alpha_n (1 - \alpha_w)n}{(\alpha_n - \alpha_w)W}
     assert isinstance(inst.tw, Fraction)
     assert isinstance(inst.tn, Fraction)
-    res = inst.tn * (1 - inst.tw) * inst.n / ((inst.tn - inst.tw) * inst.total_weight)
-    assert isinstance(res, Fraction)
-    return res
+    # With \alpha_n = a/b and \alpha_w = c/d, this is \frac{a(d - c)n}{(ad - bc)W}.
+    # Build it with a single normalization instead of a chain of fraction operations.
+    a, b = inst.tn.numerator, inst.tn.denominator
+    c, d = inst.tw.numerator, inst.tw.denominator
+    return Fraction(a * (d - c) * inst.n, (a * d - b * c) * inst.total_weight)
 
 
 def wr_solution_upper_bound(inst: WeightRestriction) -> int:
     # \left\lceil \frac{\alpha_w(1 - \alpha_w)}{\alpha_n - \alpha_w} n \right\rceil
-    return ceil(inst.tw * (1 - inst.tw) / (inst.tn - inst.tw) * inst.n)
+    # With \alpha_n = a/b and \alpha_w = c/d, this is \left\lceil \frac{bc(d - c)n}{d(ad - bc)} \right\rceil.
+    a, b = inst.tn.numerator, inst.tn.denominator
+    c, d = inst.tw.numerator, inst.tw.denominator
+    return -(-b * c * (d - c) * inst.n // (d * (a * d - b * c)))
 
 
 def allocate(inst: WeightRestriction, s: Fraction, shift: Fraction) -> List[int]:
-    return [floor(inst.weights[i] * s + shift) for i in range(inst.n)]
+    # floor(w * s + shift) = (w * s_num * shift_den + shift_num * s_den) // (s_den * shift_den),
+    # which takes a single integer division per party instead of several fraction operations
+    s, shift = Fraction(s), Fraction(shift)
+    mul = s.numerator * shift.denominator
+    add = shift.numerator * s.denominator
+    den = s.denominator * shift.denominator
+
+    if inst.weights_array is not None and max(inst.max_weight * mul + add, den) <= MAX_INT_64:
+        return ((inst.weights_array * mul + add) // den).tolist()
+    return [(w * mul + add) // den for w in inst.weights]
+
+
+def _party_weights(inst: WeightRestriction, parties: np.ndarray) -> List[int]:
+    if inst.weights_array is not None:
+        return inst.weights_array[parties].tolist()
+    return [inst.weights[i] for i in parties]
+
+
+def mix_allocations(t_low: np.ndarray, t_high: np.ndarray, low_parties: np.ndarray) -> List[int]:
+    """
+    Returns the allocation that coincides with t_low on low_parties and with t_high on all other parties.
+    """
+    mask = np.zeros(len(t_low), dtype=bool)
+    mask[low_parties] = True
+    return np.where(mask, t_low, t_high).tolist()
 
 
 def wr_solve(inst: WeightRestriction, linear: bool, no_jit: bool, verify: bool) -> List[int]:
-    assert all(isinstance(inst.weights[i], int) for i in range(inst.n))
+    if verify:
+        assert all(isinstance(w, int) for w in inst.weights)
 
     shift = inst.tw
-    eps = Fraction(1, max(inst.weights))
+    # Compare with inst.tn using integer arithmetic only to avoid creating fractions in the binary searches
+    tn_num, tn_den = inst.tn.numerator, inst.tn.denominator
+    eps = Fraction(1, inst.max_weight)
 
     # this is the largest integer smaller than inst.threshold_weight
     threshold_weight_non_strict = ceil(inst.threshold_weight) - 1
@@ -61,6 +95,26 @@ def wr_solve(inst: WeightRestriction, linear: bool, no_jit: bool, verify: bool)
     s_high = wr_upper_bound_s(inst)
     s_low = 0
 
+    # Different probes of the binary searches below often result in the same allocation.
+    # Remember the results of the knapsack computations to avoid repeating them.
+    knapsack_upper_bound_cache: Dict[Tuple[int, ...], int] = {}
+    knapsack_cache: Dict[Tuple[int, ...], bool] = {}
+
+    def knapsack_valid(t: List[int], parties: Optional[np.ndarray] = None, table: Optional[np.ndarray] = None) -> bool:
+        # Same as wr_solution_valid, but with caching.
+        # If table is given, it must be the knapsack table of all parties except for the given ones.
+        key = tuple(t)
+        if key not in knapsack_cache:
+            sum_t = sum(t)
+            if table is None:
+                weights, profits = inst.weights, t
+            else:
+                weights, profits = _party_weights(inst, parties), [t[i] for i in parties]
+            knapsack_res = knapsack(weights, profits, threshold_weight_non_strict,
+                                    upper_bound=sum_t * tn_num // tn_den + 1, no_jit=no_jit, table=table)
+            knapsack_cache[key] = knapsack_res * tn_den < tn_num * sum_t
+        return knapsack_cache[key]
+
     if verify:
         logging.debug("Verifying the upper bound...")
         assert wr_solution_valid(inst, allocate(inst, s_high, shift), no_jit), "s* upper bound is violated"
@@ -76,7 +130,12 @@ def wr_solve(inst: WeightRestriction, linear: bool, no_jit: bool, verify: bool)
         s_mid = (s_high + s_low) / 2
         t_mid = allocate(inst, s_mid, shift)
 
-        if knapsack_upper_bound(inst.weights, t_mid, threshold_weight_non_strict) < inst.tn * sum(t_mid):
+        key = tuple(t_mid)
+        if key not in knapsack_upper_bound_cache:
+            knapsack_upper_bound_cache[key] = knapsack_upper_bound(inst.weights, t_mid, threshold_weight_non_strict,
+                                                                   order=inst.descending_weight_parties)
+
+        if knapsack_upper_bound_cache[key] * tn_den < tn_num * sum(t_mid):
             s_high = s_mid
         else:
             s_low = s_mid
@@ -91,6 +150,7 @@ def wr_solve(inst: WeightRestriction, linear: bool, no_jit: bool, verify: bool)
         # Using a special type of accelerated binary search that is fast with a good initial estimate
         logging.debug("Using knapsack to find s* precisely...")
         speed = eps
+
         s_low = 0
 
         steps = 0
@@ -106,11 +166,8 @@ def wr_solve(inst: WeightRestriction, linear: bool, no_jit: bool, verify: bool)
                 s_mid = (s_high + s_low) / 2
 
             t_mid = allocate(inst, s_mid, shift)
-            sum_t_mid = sum(t_mid)
 
-            knapsack_res = knapsack(inst.weights, t_mid, threshold_weight_non_strict,
-                                    upper_bound=floor(sum_t_mid * inst.tn) + 1, no_jit=no_jit)
-            if knapsack_res < inst.tn * sum_t_mid:
+            if knapsack_valid(t_mid):
                 s_high = s_mid
             else:
                 s_low = s_mid
@@ -121,8 +178,11 @@ def wr_solve(inst: WeightRestriction, linear: bool, no_jit: bool, verify: bool)
     t_low = allocate(inst, s_low, shift)
     t_high = allocate(inst, s_high, shift)
 
-    border_set = [i for i in range(inst.n) if t_low[i] != t_high[i]]
-    assert all(t_low[i] == t_high[i] - 1 for i in border_set)
+    t_low_arr = np.array(t_low, dtype=np.int64)
+    t_high_arr = np.array(t_high, dtype=np.int64)
+
+    border_idx = np.flatnonzero(t_low_arr != t_high_arr)
+    assert np.all(t_high_arr[border_idx] - t_low_arr[border_idx] == 1)
 
     if verify:
         logging.debug("Verifying the intermediate solution...")
@@ -130,7 +190,7 @@ def wr_solve(inst: WeightRestriction, linear: bool, no_jit: bool, verify: bool)
 
     # do binary search to determine how many parties in the border set should be rounded up
     k_low = 0
-    k_high = len(border_set)
+    k_high = len(border_idx)
 
     logging.debug("Binary search for optimal k*...")
 
@@ -141,15 +201,20 @@ def wr_solve(inst: WeightRestriction, linear: bool, no_jit: bool, verify: bool)
         steps += 1
 
         k_mid = (k_high + k_low) // 2
-        t_mid = [t_low[i] if i in border_set[k_mid:] else t_high[i] for i in range(inst.n)]
+        t_mid = mix_allocations(t_low_arr, t_high_arr, border_idx[k_mid:])
 
-        if knapsack_upper_bound(inst.weights, t_mid, threshold_weight_non_strict) < inst.tn * sum(t_mid):
+        key = tuple(t_mid)
+        if key not in knapsack_upper_bound_cache:
+            knapsack_upper_bound_cache[key] = knapsack_upper_bound(inst.weights, t_mid, threshold_weight_non_strict,
+                                                                   order=inst.descending_weight_parties)
+
+        if knapsack_upper_bound_cache[key] * tn_den < tn_num * sum(t_mid):
             k_high = k_mid
         else:
             k_low = k_mid
 
     logging.debug(f"Finished in {steps} steps.")
-    logging.debug("k <= %s/%s", k_high, len(border_set))
+    logging.debug("k <= %s/%s", k_high, len(border_idx))
 
     if linear:
         logging.debug("Skipping further optimization of k* because linear mode is enabled.")
@@ -158,9 +223,23 @@ def wr_solve(inst: WeightRestriction, linear: bool, no_jit: bool, verify: bool)
         # Using a special type of accelerated binary search that is fast with a good initial estimate
         logging.debug("Using knapsack to find k* precisely...")
 
-        k_low = 0
         speed = 1
 
+        other_table = None
+        if k_high > 1:
+            # Only the allocation of the border set changes during the search.
+            # Process all other parties once and reuse the resulting knapsack table in every step.
+            other_idx = np.flatnonzero(t_low_arr == t_high_arr)
+            other_table = knapsack_table(_party_weights(inst, other_idx), t_high_arr[other_idx].tolist(),
+                                         upper_bound=sum(t_high) * tn_num // tn_den + 1, no_jit=no_jit)
+
+            # The estimate of k_low is a lower bound for k* only if the actual knapsack confirms
+            # that the allocation is invalid. In this case, keep it to save knapsack computations.
+            if k_low > 0:
+                t_mid = mix_allocations(t_low_arr, t_high_arr, border_idx[k_low:])
+                if knapsack_valid(t_mid, border_idx, other_table):
+                    k_low = 0
+
         steps = 0
         while k_high - k_low > 1:
             steps += 1
@@ -173,20 +252,17 @@ def wr_solve(inst: WeightRestriction, linear: bool, no_jit: bool, verify: bool)
                 # Fall back to regular binary search
                 k_mid = (k_high + k_low) // 2
 
-            t_mid = [t_low[i] if i in border_set[k_mid:] else t_high[i] for i in range(inst.n)]
-            sum_t_mid = sum(t_mid)
+            t_mid = mix_allocations(t_low_arr, t_high_arr, border_idx[k_mid:])
 
-            knapsack_res = knapsack(inst.weights, t_mid, threshold_weight_non_strict,
-                                    upper_bound=floor(sum_t_mid * inst.tn) + 1, no_jit=no_jit)
-            if knapsack_res < inst.tn * sum_t_mid:
+            if knapsack_valid(t_mid, border_idx, other_table):
                 k_high = k_mid
             else:
                 k_low = k_mid
 
         logging.debug(f"Finished in {steps} steps.")
-        logging.debug("k = %s/%s", k_high, len(border_set))
+        logging.debug("k = %s/%s", k_high, len(border_idx))
 
-    t_best = [t_low[i] if i in border_set[k_high:] else t_high[i] for i in range(inst.n)]
+    t_best = mix_allocations(t_low_arr, t_high_arr, border_idx[k_high:])
 
     if verify:
         logging.debug("Verifying the final solution...")
@@ -197,6 +273,8 @@ def wr_solve(inst: WeightRestriction, linear: bool, no_jit: bool, verify: bool)
 
 
 def wr_solution_valid(inst: WeightRestriction, t: List[int], no_jit: bool) -> bool:
+    tn_num, tn_den = inst.tn.numerator, inst.tn.denominator
+    sum_t = sum(t)
     knapsack_res = knapsack(inst.weights, t, ceil(inst.threshold_weight) - 1,
-                            upper_bound=floor(sum(t) * inst.tn) + 1, no_jit=no_jit)
-    return knapsack_res < inst.tn * sum(t)
+                            upper_bound=sum_t * tn_num // tn_den + 1, no_jit=no_jit)
+    return knapsack_res * tn_den < tn_num * sum_t
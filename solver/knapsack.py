@@ -6,56 +6,124 @@ from numba import njit
 import numpy as np
 from numba.core.extending import register_jitable
 
-from solver.util import lcm, rev
 
 overflow_warning = ("Integer overflow while converting fractional weights to integers for JIT compilation. "
                     "Using pure python implementation, which is much slower for large instances.")
 
 MAX_INT_64 = np.iinfo(np.int64).max
 
+# Groups of items with equal profit of at least this many times log2 of the table size are added to the knapsack
+# table at once. Adding a group costs O(m log m) scalar operations for a table of size m, while adding its items
+# one by one costs a vectorized pass over the table per item.
+EQUAL_PROFIT_GROUP_FACTOR = 4
+
 
 def knapsack(
         weights: List[int],
         profits: List[int],
         capacity: Union[Fraction, int],
         upper_bound: int,
-        no_jit: bool) -> int:
+        no_jit: bool,
+        table: Optional[np.ndarray] = None) -> int:
     """
     Solves the given knapsack instance up to the given upper bound on profit.
     Finds the set of items with the highest profit that fits into the knapsack of the given capacity if its profit
     is upper_bound or less.
     Otherwise, finds any set of items that fits into the knapsack and has profit greater than upper_bound.
 
-    If return_set is True, returns the set of items and its profit or upper_bound + 1 if it exceeds the upper bound.
-    Otherwise, returns only the profit.
+    In the latter case, the returned profit is only guaranteed to be at least upper_bound + 1:
+    the computation stops as soon as the upper bound is exceeded.
 
-    Running time: O(len(weights) * upper_bound).
-    Memory usage: O(len(weights)) if return_set is False, O(len(weights) * upper_bound) otherwise.
+    If table is given, it must be the result of knapsack_table for some other items with an upper bound
+    of at least upper_bound. These items are then available as well, and only the given ones are processed.
 
-    NB: the memory footprint can be reduced from O(len(weights) * upper_bound) to O(len(weights) + upper_bound).
-    See: Section 3.3 of "Knapsack problems" by Pisinger, D., & Toth, P. (1998)
+    Running time: O(len(weights) * upper_bound).
+    Memory usage: O(len(weights) + upper_bound).
+    When the total weight fits into 32 bits, the table uses 32-bit integers to halve the memory traffic.
     """
     assert len(weights) > 0
-
-    if no_jit:
-        return _knapsack_impl(weights, profits, capacity, upper_bound)
-
     assert isinstance(weights[0], int)
+
     # Capacity may be a fraction. However, rounding it down does not affect the result.
     capacity = int(capacity)
 
-    # Make sure that all integers fit into 64 bits to avoid overflows
-    if sum(weights) > MAX_INT_64 or sum(profits) > MAX_INT_64 or capacity > MAX_INT_64:
-        logging.warning(overflow_warning)
-        return _knapsack_impl(weights, profits, capacity, upper_bound)
+    weights, profits, table = _to_arrays(weights, profits, capacity, upper_bound, no_jit, table)
+    inf = _infinity(table.dtype)
+
+    if no_jit or weights.dtype == object:
+        return int(_knapsack_impl(weights, profits, capacity, upper_bound, table, inf, False))
 
     # Call the JIT-compiled function
-    return _knapsack_jit_int(np.array(weights, dtype=np.int64), np.array(profits, dtype=np.int64),
-                             capacity, upper_bound)
+    return int(_knapsack_jit_int(weights, profits, capacity, upper_bound, table, inf))
+
+
+def knapsack_table(
+        weights: List[int],
+        profits: List[int],
+        upper_bound: int,
+        no_jit: bool) -> np.ndarray:
+    """
+    Returns the table of the knapsack dynamic programming algorithm for the given items:
+    for each q from 0 to upper_bound + 1, the minimum weight of a subset of items with profit at least q.
+    The table can be passed to knapsack to avoid processing the same items repeatedly.
+
+    Running time: O(len(weights) * upper_bound).
+    """
+    weights, profits, table = _to_arrays(weights, profits, 0, upper_bound, no_jit, None)
+    inf = _infinity(table.dtype)
+
+    if no_jit or weights.dtype == object:
+        _knapsack_update(table, weights, profits, -1, inf, False)
+    else:
+        _knapsack_update_jit_int(table, weights, profits, -1, inf)
+
+    return table
+
+
+def _to_arrays(
+        weights: List[int],
+        profits: List[int],
+        capacity: int,
+        upper_bound: int,
+        no_jit: bool,
+        table: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Use the narrowest integer type such that all integers fit into it and the largest value can serve as infinity.
+    # Otherwise, fall back to arrays of Python integers, which cannot be JIT-compiled.
+    dtypes = [np.dtype(np.int32), np.dtype(np.int64), np.dtype(object)]
+    largest = max(sum(weights), sum(profits), capacity)
+    dtype = next(t for t in dtypes if t == object or largest < np.iinfo(t).max)
+    if dtype == object and not no_jit:
+        logging.warning(overflow_warning)
+
+    # The table may have been computed with a wider type
+    if table is not None and dtypes.index(table.dtype) > dtypes.index(dtype):
+        dtype = table.dtype
+
+    if table is None:
+        # Only the empty set of items is available
+        table = np.full(upper_bound + 2, _infinity(dtype), dtype=dtype)
+        table[0] = 0
+    else:
+        assert len(table) >= upper_bound + 2
+        if table.dtype != dtype:
+            converted = table.astype(dtype)
+            converted[table == _infinity(table.dtype)] = _infinity(dtype)
+            table = converted
+
+    return np.array(weights, dtype=dtype), np.array(profits, dtype=dtype), table
+
+
+def _infinity(dtype) -> Union[int, float]:
+    """
+    Returns the value that stands for an infinite weight in the tables of the given type.
+    """
+    if dtype == object:
+        return float("inf")
+    return np.dtype(dtype).type(np.iinfo(dtype).max)
 
 
 @register_jitable
-def _knapsack_impl(weights, profits, capacity, upper_bound) -> int:
+def _knapsack_impl(weights, profits, capacity, upper_bound, table, inf, group_equal_profits) -> int:
 
     assert len(weights) == len(profits)
 
@@ -64,46 +132,180 @@ def _knapsack_impl(weights, profits, capacity, upper_bound) -> int:
         if weights[i] <= capacity and profits[i] > upper_bound:
             return profits[i]
 
-    # Ignore items with zero profit
-    nonzero_items = [i for i in range(len(weights)) if profits[i] > 0]
+    # dp[q] is the minimum weight of a subset of items with profit at least q.
+    m = upper_bound + 2
+    dp = table[:m].copy()
+
+    # The profit exceeds the upper bound, the remaining items cannot change the answer
+    if dp[m - 1] <= capacity or _knapsack_update(dp, weights, profits, capacity, inf, group_equal_profits):
+        return m - 1
+
+    # Solution is the maximum index of y that does not surpass capacity
+    return np.flatnonzero(dp <= capacity)[-1]
+
+
+@register_jitable
+def _knapsack_update(dp, weights, profits, capacity, inf, group_equal_profits) -> bool:
+    """
+    Adds the given items to the dp table in place.
+    Stops early and returns True if the last entry of the table fits into the capacity.
+
+    If group_equal_profits is True, large groups of items with equal profits are added at once.
+    This only pays off when compiled, since it is not vectorized.
+    """
+    m = len(dp)
+
+    # Ignore items with zero profit.
+    # Process the items in the order of increasing profit and, for equal profits, increasing weight.
+    nonzero_items = np.flatnonzero(profits > 0)
+    nonzero_items = nonzero_items[np.argsort(weights[nonzero_items], kind="mergesort")]
+    nonzero_items = nonzero_items[np.argsort(profits[nonzero_items], kind="mergesort")]
     n_nonzero = len(nonzero_items)
 
-    # after i-th iteration of the loop, dp[i] is the minimum weight of a subset of items 0, ..., i
+    # Buffer for the candidate values, allocated once and reused for all items
+    tmp = np.empty(m, dtype=dp.dtype)
+
+    # after each iteration of the outer loop, dp[q] is the minimum weight of a subset of the items processed so far
     # with profit at least q.
-    dp: List[int] = [0 if q == 0 else MAX_INT_64 for q in range(upper_bound + 2)]
+    group_start = 0
+    while group_start < n_nonzero:
+        p = profits[nonzero_items[group_start]]
 
-    # Run the dynamic programming algorithm
-    for i in range(n_nonzero):
-        item = nonzero_items[i]
+        group_end = group_start
+        while group_end < n_nonzero and profits[nonzero_items[group_end]] == p:
+            group_end += 1
+        group_weights = weights[nonzero_items[group_start:group_end]]
+        group_start = group_end
 
-        # Update the `dp` from right to left to avoid overwriting the values that we still need
-        for q in rev(range(upper_bound + 2)):
-            if profits[item] >= q:
-                dp[q] = min(dp[q], weights[item])
-            elif dp[q - profits[item]] != MAX_INT_64:
-                dp[q] = min(dp[q], dp[q - profits[item]] + weights[item])
+        if (group_equal_profits and len(group_weights) >= EQUAL_PROFIT_GROUP_FACTOR * np.log2(m) and p < m
+                and _largest_finite(dp, inf) <= inf - np.sum(group_weights)):
+            _add_equal_profit_items(dp, p, group_weights, inf)
+            if dp[m - 1] <= capacity:
+                return True
+            continue
 
-    # Solution is the maximum index of y that does not surpass capacity
-    return max([q for q in range(upper_bound + 2) if dp[q] <= capacity])
+        # For q < p, the item alone is enough: dp[q] = min(dp[q], w).
+        # For q >= p, dp[q] = min(dp[q], dp[q - p] + w).
+        # The candidates are computed into `tmp` before `dp` is updated, so every read sees the previous values.
+        lo = min(p, m)
+        for w in group_weights:
+            if lo < m:
+                cand = tmp[:m - lo]
+                _saturating_add(dp[:m - lo], w, inf, cand)
+                np.minimum(dp[lo:], cand, dp[lo:])
+            np.minimum(dp[:lo], w, dp[:lo])
+
+            if dp[m - 1] <= capacity:
+                return True
+
+    return False
+
+
+@register_jitable
+def _add_equal_profit_items(dp, p, weights, inf) -> None:
+    """
+    Adds items with the same profit p and the given weights, sorted in ascending order, to the dp table in place.
+
+    Any j of these items weigh at least as much as the j lightest ones, so the new value of dp[q] is the minimum of
+    dp[q - j * p] + prefix[j] over j, where prefix[j] is the total weight of the j lightest items.
+    The sequence prefix is convex. Hence, within each residue class of q modulo p, the optimal j is monotone in q,
+    and the minima can be found with divide and conquer in O(len(dp) * log(len(dp))) time
+    instead of O(len(weights) * len(dp)).
+
+    All finite values in dp plus the total weight of the items must be smaller than the infinite weight,
+    so that only the infinite values saturate.
+    """
+    m = len(dp)
+    c = len(weights)
+
+    prefix = np.zeros(c + 1, dtype=dp.dtype)
+    for j in range(c):
+        prefix[j + 1] = prefix[j] + weights[j]
+
+    for r in range(p):
+        # a[k + 1] = dp[r + k * p] and a[0] = 0, which corresponds to q - j * p < 0,
+        # i.e., to the case when the items alone have enough profit.
+        n_rows = (m - 1 - r) // p + 1
+        a = np.zeros(n_rows + 1, dtype=dp.dtype)
+        a[1:] = dp[r::p]
+        res = np.empty(n_rows, dtype=dp.dtype)
+
+        # Row i stands for q = r + i * p, column k for a[k], which corresponds to j = i + 1 - k.
+        # Each entry of the stack is (first row, last row, first column, last column).
+        stack = [(0, n_rows - 1, 0, n_rows)]
+        while len(stack) > 0:
+            row_lo, row_hi, col_lo, col_hi = stack.pop()
+            if row_lo > row_hi:
+                continue
+
+            i = (row_lo + row_hi) // 2
+            first = max(col_lo, i + 1 - c)
+            best_k = first
+            best = min(a[first], inf - prefix[i + 1 - first]) + prefix[i + 1 - first]
+            for k in range(first + 1, min(col_hi, i + 1) + 1):
+                cost = min(a[k], inf - prefix[i + 1 - k]) + prefix[i + 1 - k]
+                if cost < best:
+                    best, best_k = cost, k
+            res[i] = best
 
+            stack.append((row_lo, i - 1, col_lo, best_k))
+            stack.append((i + 1, row_hi, best_k, col_hi))
 
-@njit
+        dp[r::p] = res
+
+
+@register_jitable
+def _largest_finite(dp, inf):
+    res = dp[0]
+    for x in dp:
+        if x < inf and x > res:
+            res = x
+    return res
+
+
+@register_jitable
+def _saturating_add(a, b, inf, out) -> None:
+    """
+    Computes min(a + b, inf) elementwise without overflows and without branches.
+    Thus, adding to the infinite weight keeps it infinite.
+    """
+    np.minimum(a, inf - b, out)
+    out += b
+
+
+@njit(nogil=True, cache=True)
 def _knapsack_jit_int(
         weights: np.array,
         profits: np.array,
         capacity: np.int64,
-        upper_bound: int) -> int:
-    return _knapsack_impl(weights, profits, capacity, upper_bound)
+        upper_bound: int,
+        table: np.array,
+        inf: int) -> int:
+    return _knapsack_impl(weights, profits, capacity, upper_bound, table, inf, True)
+
+
+@njit(nogil=True, cache=True)
+def _knapsack_update_jit_int(
+        dp: np.array,
+        weights: np.array,
+        profits: np.array,
+        capacity: np.int64,
+        inf: int) -> bool:
+    return _knapsack_update(dp, weights, profits, capacity, inf, True)
 
 
 def knapsack_upper_bound(
         weights: List[Union[Fraction, float, int]],
         profits: List[int],
         capacity: Union[Fraction, float, int],
+        order: Optional[List[int]] = None,
 ) -> int:
     """
     Returns an upper bound for the knapsack solution in quasilinear time.
 
+    If order is given, it must be a permutation of the items. The items are sorted by efficiency starting from it,
+    which is considerably faster when it is already close to the descending efficiency order.
+
     NB: this upper bound can be computed in linear time using a slightly more complicated algorithm.
     See: Section 3.1 of "Knapsack problems" by Pisinger, D., & Toth, P. (1998)
     """
@@ -111,7 +313,15 @@ def knapsack_upper_bound(
     n = len(weights)
     assert len(profits) == n
 
-    descending_efficiency_parties = sorted(range(n), key=lambda i: profits[i] / weights[i], reverse=True)
+    if order is None:
+        order = range(n)
+    else:
+        assert len(order) == n
+
+    # Items with zero profit come last and cannot increase the bound, so there is no need to sort them.
+    # In this solver, they are often the majority.
+    nonzero_parties = [i for i in order if profits[i] > 0]
+    descending_efficiency_parties = sorted(nonzero_parties, key=lambda i: profits[i] / weights[i], reverse=True)
 
     profit = 0
     for party in descending_efficiency_parties:
@@ -1,23 +1,12 @@
 import math
-
-from numba.core.extending import register_jitable
+from functools import reduce
 
 
+# Folding with the C implementations of math.lcm and math.gcd (Python 3.9+) avoids a Python-level loop.
+# Unlike math.lcm(*xs), this does not unpack a possibly huge iterable into arguments.
 def lcm(xs):
-    res = 1
-    for x in xs:
-        res = res * x // math.gcd(res, x)
-    return res
+    return reduce(math.lcm, xs, 1)
 
 
 def gcd(xs):
-    res = 0
-    for x in xs:
-        res = math.gcd(res, x)
-    return res
-
-
-# Unfortunately, Python's native `reserved` function is not jitable.
-@register_jitable
-def rev(rng: range) -> range:
-    return range(rng.start + (len(rng) - 1) * rng.step, rng.start - rng.step, -rng.step)
+    return reduce(math.gcd, xs, 0)
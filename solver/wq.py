@@ -1,5 +1,5 @@
 from fractions import Fraction
-from typing import List, Union
+from typing import List, Optional, Union
 
 from solver.wr import WeightRestriction
 
@@ -31,6 +31,8 @@ class WeightQualification:
         self.tw = tw
         # Threshold on the fraction of tickets allocated to the adversary
         self.tn = tn
+        # The equivalent Weight Restriction instance, created on the first call to to_wr
+        self._wr: Optional[WeightRestriction] = None
 
     def __str__(self):
         return f"WeightQualification < " \
@@ -40,7 +42,9 @@ class WeightQualification:
     def __repr__(self):
         return str(self)
 
-    def to_wr(self):
-        return WeightRestriction(self.weights, 1 - self.tw, 1 - self.tn)
+    def to_wr(self) -> WeightRestriction:
+        if self._wr is None:
+            self._wr = WeightRestriction(self.weights, 1 - self.tw, 1 - self.tn)
+        return self._wr
 
 
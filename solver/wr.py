@@ -1,6 +1,8 @@
 from fractions import Fraction
 from typing import List
 
+import numpy as np
+
 
 class WeightRestriction:
 
@@ -20,12 +22,20 @@ class WeightRestriction:
         self.weights = weights
         # Total weight of all parties
         self.total_weight = sum(weights)
+        # Maximum weight of a single party
+        self.max_weight = max(weights)
+        # Weights as an array of 64-bit integers, or None if they do not fit into it
+        self.weights_array = None
+        if all(isinstance(w, int) for w in weights) and 0 <= min(weights) and self.max_weight <= np.iinfo(np.int64).max:
+            self.weights_array = np.array(weights, dtype=np.int64)
         # Maximum possible total weight of Byzantine parties
         self.threshold_weight = tw * self.total_weight
         # Threshold on the fraction of total weight controlled by the adversary
         self.tw = tw
         # Threshold on the fraction of tickets allocated to the adversary
         self.tn = tn
+        # Parties sorted by decreasing weight
+        self.descending_weight_parties = sorted(range(self.n), key=lambda i: weights[i], reverse=True)
 
     def __str__(self):
         return f"WeightRestriction < " \